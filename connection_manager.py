@@ -1,11 +1,13 @@
 import os
+from collections import defaultdict
 from datetime import date
-from typing import Dict, Optional
+from typing import Dict, List, Optional, Set
 from fastapi import WebSocket
-import json
+from starlette.websockets import WebSocketState
 import logging
 import asyncio
 
+import orjson
 from fastapi.encoders import jsonable_encoder
 
 from models import ScanRequest, ConnectionType
@@ -15,63 +17,158 @@ from feign_database import FeignDatabase
 
 logger = logging.getLogger(__name__)
 
+# Фоновая синхронизация с Firebird: ограниченная очередь;
+# воркеров столько же, сколько соединений в пуле Firebird (FEIGN_POOL_SIZE)
+LEGACY_SYNC_QUEUE_SIZE = 10_000
+
+# Исходящая очередь на каждое выходное соединение; при переполнении сообщения для него отбрасываются
+OUTBOUND_QUEUE_SIZE = 256
+# Сколько накопившихся сообщений склеивается в один кадр для клиентов, включивших batch
+OUTBOUND_BATCH_SIZE = 32
+
+# Межпроцессная рассылка через PostgreSQL LISTEN/NOTIFY: сообщения платформ и события логинов
+# (сканер подключен/отключен, смена платформы) — читатель может сидеть на другом воркере, чем его сканер
+BROADCAST_CHANNEL = "scanner_broadcast"
+# NOTIFY принимает payload до 8000 байт; более крупные сообщения доставляем только локально
+NOTIFY_PAYLOAD_LIMIT = 7900
+
+
+class _LazyUsersDump:
+    """Сериализует состояние пользователей только при реальном выводе лога."""
+
+    def __init__(self, users):
+        self.users = users
+
+    def __str__(self):
+        return orjson.dumps([v.to_dict() for v in self.users]).decode()
+
 
 class ConnectionManager:
-    def __init__(self, db: DatabaseManager, feign_db: FeignDatabase):
+    def __init__(self, db: DatabaseManager, feign_db: FeignDatabase, cluster_broadcast: bool = False):
         self.users: Dict[str, UserContext] = {}
+        # Вторичный индекс: платформа -> пользователи, находящиеся на ней
+        self.platform_index: Dict[int, Set[UserContext]] = defaultdict(set)
         self.db: DatabaseManager = db
         self.feign_db: FeignDatabase = feign_db
+        self._sync_queue: asyncio.Queue = asyncio.Queue(maxsize=LEGACY_SYNC_QUEUE_SIZE)
+        self._sync_workers: List[asyncio.Task] = []
+        # При нескольких воркерах uvicorn рассылка по платформам идет через NOTIFY
+        self.cluster_broadcast = cluster_broadcast
+        # Входящие NOTIFY разбираются по одному в порядке прихода
+        self._notify_inbox: asyncio.Queue = asyncio.Queue()
+        self._notify_worker_task: Optional[asyncio.Task] = None
+        # Состояние логинов на других воркерах: метки воркеров с подключенным сканером и последняя платформа
+        self._remote_scanners: Dict[str, Set[str]] = defaultdict(set)
+        self._login_platforms: Dict[str, int] = {}
+        # Метка процесса в рассылке: собственные NOTIFY уже доставлены локально и пропускаются
+        self._origin = f"{os.getpid()}:{os.urandom(4).hex()}"
+        # websocket -> (очередь исходящих payload, задача-отправитель)
+        self._outboxes: Dict[WebSocket, tuple[asyncio.Queue, asyncio.Task]] = {}
         logger.info("ConnectionManager инициализирован")
 
-    async def connect(self, websocket: WebSocket, user_data: Dict[str, any], conn_type: ConnectionType):
+    async def start(self):
+        """Подписывается на межпроцессную рассылку, если она включена."""
+        if self.cluster_broadcast:
+            self._notify_worker_task = asyncio.create_task(self._notify_worker())
+            await self.db.listen(BROADCAST_CHANNEL, self._on_notify)
+
+    def _ensure_sync_workers(self):
+        """Запускает воркеры синхронизации при первой необходимости (нужен работающий event loop)."""
+        if not self._sync_workers:
+            # Больше воркеров, чем соединений, только ждали бы пул; меньше — не использовали бы его
+            workers = max(1, self.feign_db.pool_size)
+            self._sync_workers = [asyncio.create_task(self._sync_worker()) for _ in range(workers)]
+
+    async def close(self):
+        """Останавливает воркеры синхронизации и отправителей."""
+        tasks = [*self._sync_workers, *(task for _, task in self._outboxes.values())]
+        if self._notify_worker_task is not None:
+            tasks.append(self._notify_worker_task)
+            self._notify_worker_task = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._sync_workers = []
+        self._outboxes.clear()
+
+    async def connect(self, websocket: WebSocket, user_data: Dict[str, any], conn_type: ConnectionType,
+                      batch: bool = False) -> UserContext:
         login = user_data["login"]
 
         # 1. Создаем контекст, если его нет
         if login not in self.users:
+            # Платформу, выбранную сканером на другом воркере, новый контекст получает сразу
+            platform = self._login_platforms.get(login)
             self.users[login] = UserContext(
                 login=login,
+                current_platform=platform,
                 id=user_data["id"],
                 fullname=user_data["fullname"]
             )
+            if platform is not None:
+                self.platform_index[platform].add(self.users[login])
             logger.info(f"Контекст создан. Пользователь: {login}")
 
         user_ctx = self.users[login]
 
         if conn_type in [ConnectionType.WRITER, ConnectionType.READWRITER]:
-            user_ctx.input_connections.append(websocket)
-            if len(user_ctx.input_connections) >= 1:
-                await self._broadcast_event(user_ctx, {"event": "scanner_connected"})
+            # Оповещаем читателей только при появлении первого сканера (с учетом других воркеров)
+            was_empty = not user_ctx.input_connections
+            had_scanner = self._has_scanner(login)
+            user_ctx.input_connections.add(websocket)
+            if was_empty:
+                if not had_scanner:
+                    await self._broadcast_event(user_ctx, {"event": "scanner_connected"})
+                await self._notify({"login": login, "event": "scanner_connected"})
 
         if conn_type in [ConnectionType.READER, ConnectionType.READWRITER]:
-            user_ctx.output_connections.append(websocket)
-            if user_ctx.input_connections:
-                try:
-                    await websocket.send_json({"event": "scanner_connected"})
-                except Exception:
-                    pass
+            user_ctx.output_connections.add(websocket)
+            self._open_outbox(user_ctx, websocket, batch)
+            if self._has_scanner(login):
+                # Через очередь соединения: кадр оформляется так же, как остальные (массив при batch)
+                self._enqueue(user_ctx, websocket, self._encode({"event": "scanner_connected"}))
 
         # 5. Логирование (только в DEV)
         if os.getenv("MODE") == "DEV":
             await self._log_all_users()
 
+        return user_ctx
+
     async def disconnect(self, websocket: WebSocket, login: str, type: ConnectionType):
         if login not in self.users: return
         user = self.users[login]
 
         if type in [ConnectionType.WRITER, ConnectionType.READWRITER]:
-            if websocket in user.input_connections: user.input_connections.remove(websocket)
+            user.input_connections.discard(websocket)
             if not user.input_connections:
-                await self._broadcast_event(user, {"event": "scanner_refused"})
+                if not self._has_scanner(login):
+                    await self._broadcast_event(user, {"event": "scanner_refused"})
+                await self._notify({"login": login, "event": "scanner_refused"})
 
         if type in [ConnectionType.READER, ConnectionType.READWRITER]:
-            if websocket in user.output_connections: user.output_connections.remove(websocket)
+            user.output_connections.discard(websocket)
+            self._close_outbox(websocket)
 
         if not user.input_connections and not user.output_connections:
+            self._unindex_platform(user)
             del self.users[login]
 
+    def _has_scanner(self, login: str) -> bool:
+        """Подключен ли у логина сканер в этом процессе или на другом воркере."""
+        user = self.users.get(login)
+        return bool(user is not None and user.input_connections) or bool(self._remote_scanners.get(login))
+
+    def _unindex_platform(self, user: UserContext):
+        users = self.platform_index.get(user.current_platform)
+        if users is not None:
+            users.discard(user)
+            if not users:
+                del self.platform_index[user.current_platform]
+
     async def _log_all_users(self):
-        users_state = [v.to_dict() for _, v in self.users.items()]
-        logger.info(f"Users State: {json.dumps(users_state, ensure_ascii=False)}")
+        if not logger.isEnabledFor(logging.INFO):
+            return
+        logger.info("Users State: %s", _LazyUsersDump(tuple(self.users.values())))
 
     async def get_user(self, login: str) -> Optional[UserContext]:
         return self.users.get(login)
@@ -80,16 +177,130 @@ class ConnectionManager:
         return [v.to_dict() for _, v in self.users.items()]
 
     async def _broadcast_event(self, user: UserContext, msg: dict):
-        for conn in user.output_connections[:]:
-            try:
-                await conn.send_json(jsonable_encoder(msg))
-            except Exception as ex:
-                logger.error(f"WebSocket error: {ex}")
+        await self._broadcast_payload(user, self._encode(msg))
+
+    @staticmethod
+    def _encode(msg: dict) -> str:
+        """Сериализует сообщение один раз для всех получателей."""
+        return orjson.dumps(jsonable_encoder(msg)).decode()
+
+    async def _broadcast_payload(self, user: UserContext, payload: str):
+        """Ставит уже сериализованный payload в исходящие очереди всех выходных соединений."""
+        for conn in tuple(user.output_connections):
+            # Закрытые сокеты отбрасываем сразу, не ставя на них отправку
+            if conn.client_state == WebSocketState.CONNECTED and conn.application_state == WebSocketState.CONNECTED:
+                self._enqueue(user, conn, payload)
+            else:
+                user.output_connections.discard(conn)
+                self._close_outbox(conn)
+
+    def _open_outbox(self, user: UserContext, websocket: WebSocket, batch: bool = False):
+        """Создает очередь и единственную задачу-отправителя для выходного соединения."""
+        if websocket not in self._outboxes:
+            outbox = asyncio.Queue(maxsize=OUTBOUND_QUEUE_SIZE)
+            task = asyncio.create_task(self._sender(user, websocket, outbox, batch))
+            self._outboxes[websocket] = (outbox, task)
+
+    def _close_outbox(self, websocket: WebSocket):
+        entry = self._outboxes.pop(websocket, None)
+        if entry is not None:
+            entry[1].cancel()
+
+    def _enqueue(self, user: UserContext, websocket: WebSocket, payload: str):
+        entry = self._outboxes.get(websocket)
+        if entry is None:
+            return
+        try:
+            entry[0].put_nowait(payload)
+        except asyncio.QueueFull:
+            # Медленный клиент не должен тормозить рассылку остальным
+            logger.warning(f"Outbound queue is full for {user.login}, message dropped")
+
+    async def _sender(self, user: UserContext, websocket: WebSocket, outbox: asyncio.Queue, batch: bool):
+        try:
+            while True:
+                payload = await outbox.get()
+                if batch:
+                    # Все, что успело накопиться, уходит одним кадром — JSON-массивом сообщений
+                    payloads = [payload]
+                    while len(payloads) < OUTBOUND_BATCH_SIZE and not outbox.empty():
+                        payloads.append(outbox.get_nowait())
+                    payload = f"[{','.join(payloads)}]"
+                await websocket.send_text(payload)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Мертвый сокет убираем, чтобы не слать в него повторно
+            logger.error(f"WebSocket error: {e}")
+            user.output_connections.discard(websocket)
+            entry = self._outboxes.get(websocket)
+            if entry is not None and entry[1] is asyncio.current_task():
+                del self._outboxes[websocket]
 
     async def _send_to_platform(self, platform_id: int, msg: dict):
-        for user in self.users.values():
-            if user.current_platform == platform_id:
-                await self._broadcast_event(user, msg)
+        payload = self._encode(msg)
+        # Локальным пользователям доставляем сразу, не дожидаясь NOTIFY: доставка не зависит от LISTEN
+        await self._deliver_to_platform(platform_id, payload)
+        await self._notify({"platform": platform_id, "payload": payload})
+
+    async def _notify(self, data: dict):
+        """Публикует событие остальным воркерам, если межпроцессная рассылка включена."""
+        if not self.cluster_broadcast:
+            return
+        envelope = orjson.dumps({"origin": self._origin, **data})
+        if len(envelope) > NOTIFY_PAYLOAD_LIMIT:
+            return
+        try:
+            await self.db.notify(BROADCAST_CHANNEL, envelope.decode())
+        except Exception as e:
+            # Другие воркеры это событие не получат, но локальная доставка уже прошла
+            logger.error(f"NOTIFY {BROADCAST_CHANNEL} не отправлен: {e}")
+
+    def _on_notify(self, connection, pid: int, channel: str, envelope: str):
+        data = orjson.loads(envelope)
+        if data.get("origin") == self._origin:
+            return
+        self._notify_inbox.put_nowait(data)
+
+    async def _notify_worker(self):
+        while True:
+            data = await self._notify_inbox.get()
+            try:
+                await self._handle_notification(data)
+            except Exception as e:
+                logger.error(f"NOTIFY {BROADCAST_CHANNEL}: ошибка обработки события: {e}")
+
+    async def _handle_notification(self, data: dict):
+        """Применяет событие другого воркера к локальным контекстам."""
+        login = data.get("login")
+        if login is None:
+            await self._deliver_to_platform(data["platform"], data["payload"])
+            return
+
+        user = self.users.get(login)
+        event = data["event"]
+        if event == "change_platform":
+            self._login_platforms[login] = data["platform"]
+            if user is not None and user.current_platform != data["platform"]:
+                await self._change_platform(user, data["platform"])
+        elif event == "scanner_connected":
+            had_scanner = self._has_scanner(login)
+            self._remote_scanners[login].add(data["origin"])
+            if user is not None and not had_scanner:
+                await self._broadcast_event(user, {"event": "scanner_connected"})
+        elif event == "scanner_refused":
+            origins = self._remote_scanners.get(login)
+            if origins is not None:
+                origins.discard(data["origin"])
+                if not origins:
+                    del self._remote_scanners[login]
+            if user is not None and not self._has_scanner(login):
+                await self._broadcast_event(user, {"event": "scanner_refused"})
+
+    async def _deliver_to_platform(self, platform_id: int, payload: str):
+        """Рассылает payload локальным пользователям платформы."""
+        for user in tuple(self.platform_index.get(platform_id, ())):
+            await self._broadcast_payload(user, payload)
 
     async def handle_new_pair(self, login: str, platform: int, product: int | None):
 
@@ -99,30 +310,20 @@ class ConnectionManager:
 
         # 1. СМЕНА ПЛАТФОРМЫ
         if user.current_platform != platform:
-            user.current_platform = platform
-            await self._broadcast_event(user, {
-                "event": "change_platform",
-                "data": {
-                    "platform": platform,
-                    "products": await self.db.get_scan_pairs(platform=platform,
-                                                             is_overwritten=False,
-                                                             date_from=date.today(),
-                                                             date_to=date.today()
-                                                             , sort="scan_date,desc"
-                                                             )
-                }
-            }
-                                        )
+            await self._change_platform(user, platform)
+            if self.cluster_broadcast:
+                self._login_platforms[login] = platform
+            # Список продуктов другие воркеры запрашивают сами — в NOTIFY уходит только платформа
+            await self._notify({"login": login, "event": "change_platform", "platform": platform})
 
         # 2. НОВЫЙ ПРОДУКТ
         if product is not None:
-            # Проверяем, был ли такой продукт ранее (логика перезаписи)
-            old_entry = await self.db.check_and_mark_overwrite(product)
-            is_overwriting = old_entry is not None
-            old_platform = old_entry['platform'] if is_overwriting else None
-
             # Записываем в нашу новую базу (по умолчанию legacy_synced = 0)
-            scan_id = await self.db.add_scan(ScanRequest(login=login, platform=platform, product=product))
+            # и в том же запросе помечаем прошлую запись продукта как перезаписанную
+            result = await self.db.add_scan(ScanRequest(login=login, platform=platform, product=product))
+            scan_id = result['scan_id']
+            is_overwriting = result['old_id'] is not None
+            old_platform = result['old_platform']
 
             new_pair_msg = {
                 "event": "new_pair",
@@ -146,8 +347,42 @@ class ConnectionManager:
                 await self._send_to_platform(platform, new_pair_msg)
 
             # 3. АСИНХРОННАЯ СИНХРОНИЗАЦИЯ С УДАЛЕННОЙ БАЗОЙ
-            # Мы не используем to_thread, так как feign_db.save_pair теперь асинхронная
-            asyncio.create_task(self._sync_with_legacy(scan_id, platform, product))
+            # Ставим в ограниченную очередь; при переполнении сразу фиксируем ошибку (-1)
+            self._ensure_sync_workers()
+            try:
+                self._sync_queue.put_nowait((scan_id, platform, product))
+            except asyncio.QueueFull:
+                logger.error(f"Sync queue is full, scan_id {scan_id} not synced")
+                await self.db.update_sync_status(scan_id, -1, "Legacy sync queue is full")
+
+    async def _change_platform(self, user: UserContext, platform: int):
+        """Переводит контекст на платформу и рассылает его читателям продукты платформы за сегодня."""
+        self._unindex_platform(user)
+        user.current_platform = platform
+        self.platform_index[platform].add(user)
+        await self._broadcast_event(user, {
+            "event": "change_platform",
+            "data": {
+                "platform": platform,
+                "products": await self.db.get_scan_pairs(platform=platform,
+                                                         is_overwritten=False,
+                                                         date_from=date.today(),
+                                                         date_to=date.today()
+                                                         , sort="scan_date,desc"
+                                                         )
+            }
+        }
+                                    )
+
+    async def _sync_worker(self):
+        while True:
+            scan_id, platform, product = await self._sync_queue.get()
+            try:
+                await self._sync_with_legacy(scan_id, platform, product)
+            except Exception as e:
+                logger.error(f"Sync worker error for scan_id {scan_id}: {e}")
+            finally:
+                self._sync_queue.task_done()
 
     async def _sync_with_legacy(self, scan_id: int, platform: int, product: int):
         """
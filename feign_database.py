@@ -1,21 +1,35 @@
 import logging
 import asyncio
+import queue
+from collections import OrderedDict
+from contextlib import contextmanager
 from urllib.parse import urlparse
 from datetime import datetime
 from typing import Optional, Dict
 from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
 
 import firebirdsql
 
 logger = logging.getLogger(__name__)
 
+# Кэш найденных пользователей: логины сканеров проверяются на каждом подключении
+USER_CACHE_SIZE = 5_000
+USER_CACHE_TTL = 60.0
+
 
 class FeignDatabase:
-    def __init__(self, dsn: str):
+    def __init__(self, dsn: str, pool_size: int = 4):
         self.dsn = dsn
-        self.connection = None
+        self.pool_size = pool_size
+        # Пул соединений Firebird: по одному соединению на поток executor-а.
+        # None в пуле — слот, соединение для которого будет открыто заново при выдаче
+        self._pool: queue.Queue = queue.Queue()
         # Пул потоков для выполнения синхронных запросов к Firebird
-        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._executor = ThreadPoolExecutor(max_workers=pool_size)
+        # login -> (истекает, пользователь); отсутствующие пользователи не кэшируются
+        self._user_cache: "OrderedDict[str, tuple[float, Dict]]" = OrderedDict()
+        self._user_inflight: Dict[str, asyncio.Future] = {}
 
         try:
             parsed = urlparse(dsn)
@@ -26,7 +40,7 @@ class FeignDatabase:
             # Для отладки
             logger.info(f"Подключение к Firebird: {parsed.hostname}:{parsed.port} DB: {db_path}")
 
-            self.connection = firebirdsql.connect(
+            self._connect_params = dict(
                 host=parsed.hostname,
                 port=parsed.port,
                 database=db_path,
@@ -35,13 +49,34 @@ class FeignDatabase:
                 charset=charset,
                 auth_plugin_name='Legacy_Auth'
             )
+            for _ in range(pool_size):
+                self._pool.put(firebirdsql.connect(**self._connect_params))
 
-            logger.info(f"FeignDatabase: Успешно подключено к {parsed.hostname}")
+            logger.info(f"FeignDatabase: Успешно подключено к {parsed.hostname} (соединений: {pool_size})")
 
         except Exception as e:
             logger.error(f"Ошибка инициализации FeignDatabase: {e}")
             raise
 
+    @contextmanager
+    def _connection(self):
+        """Выдает соединение из пула; после ошибки соединение закрывается и слот переоткрывается при следующей выдаче."""
+        conn = self._pool.get()
+        try:
+            if conn is None:
+                conn = firebirdsql.connect(**self._connect_params)
+            yield conn
+        except Exception:
+            if conn is not None:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+            conn = None
+            raise
+        finally:
+            self._pool.put(conn)
+
     def _get_days_since_1900_offset(self) -> float:
         # TDateTime (Delphi) starts from Dec 30, 1899.
         # Python datetime(1900, 1, 1) is day 2. So we add 2. Correct.
@@ -53,15 +88,26 @@ class FeignDatabase:
     # Синхронный метод для выполнения в executor
     def _get_user_sync(self, login: str) -> Optional[Dict]:
         query = "SELECT IDUSER, CAPTION, PSW FROM USERS WHERE PSW = ?"
-        cursor = self.connection.cursor()
-        try:
-            cursor.execute(query, (login,))
-            row = cursor.fetchone()
-            if row:
-                return {"id": row[0], "fullname": row[1], "login": row[2]}
-            return None
-        finally:
-            cursor.close()
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(query, (login,))
+                row = cursor.fetchone()
+                if row:
+                    return {"id": row[0], "fullname": row[1], "login": row[2]}
+                return None
+            finally:
+                cursor.close()
+
+    def _ping_sync(self) -> bool:
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute("SELECT 1 FROM RDB$DATABASE")
+                cursor.fetchone()
+                return True
+            finally:
+                cursor.close()
 
     # Синхронный метод сохранения
     def _save_pair_sync(self, platform: int, product: int) -> bool:
@@ -69,71 +115,87 @@ class FeignDatabase:
         firstpart = product // 1000
         secondpart = product % 1000
 
-        cursor = self.connection.cursor()
-        try:
-            # 1. Update LISTHAFF
-            update_query = """
-                           UPDATE LISTHAFF
-                           SET DOTINSKL    = COALESCE(DOTINSKL, ?),
-                               NCAR        = ?,
-                               DOTINSKLPOV = ?
-                           WHERE IDLISTHAFF = ? \
-                             AND IDPRNT = ? \
-                           """
-            cursor.execute(update_query, (time_val, platform, time_val, firstpart, secondpart))
-
-            # 2. Find DOGOVOR
-            find_dogovor_query = """
-                                 SELECT c.IDDOGOVOR
-                                 FROM LISTHAFF a
-                                          JOIN LISTIZD b ON a.IDIZD = b.ID
-                                          JOIN DOGOVOR c ON b.IDDOG = c.IDDOGOVOR
-                                 WHERE a.IDLISTHAFF = ? \
-                                   AND a.IDPRNT = ? \
-                                 """
-            cursor.execute(find_dogovor_query, (firstpart, secondpart))
-            res = cursor.fetchone()
-
-            if res:
-                iddogovor = res[0]
-                # 3. Check remaining
-                check_ready_query = """
-                                    SELECT COUNT(*)
-                                    FROM LISTHAFF a
-                                             JOIN LISTIZD b ON a.IDIZD = b.ID
-                                    WHERE b.IDDOG = ? \
-                                      AND a.DOTINSKL IS NULL \
-                                    """
-                cursor.execute(check_ready_query, (iddogovor,))
-                remaining = cursor.fetchone()[0]
-
-                if remaining == 0:
-                    cursor.execute("UPDATE DOGOVOR SET SOSDOG = 4 WHERE IDDOGOVOR = ?", (iddogovor,))
-                    # EXECUTE PROCEDURE часто требует commit для применения эффекта
-                    cursor.execute("EXECUTE PROCEDURE MAKEDOC(?, ?)", (iddogovor, time_val))
-
-            self.connection.commit()
-            logger.info(f"Firebird: Сохранено product={product} platform={platform}")
-            return True
-
-        except Exception as e:
-            self.connection.rollback()
-            logger.error(f"Firebird Error in save_pair: {e}")
-            raise
-        finally:
-            cursor.close()
-
-    # Асинхронные обертки
-    def get_user_by_login(self, login: str) -> Optional[Dict]:
-        # Этот метод вызывается в auth/login, который async.
-        # Но если firebirdsql блокирующий, лучше бы ему быть async def и использовать run_in_executor
-        # Но в вашем коде auth_login вызывает его синхронно (без await).
-        # FastAPI запустит auth_login в отдельном потоке если он def, но он async def...
-        # ПРАВИЛЬНО: Вызывать блокирующие операции в executor.
-
-        # Для простоты, пока оставим синхронным, но знайте: это блокирует loop.
-        # В идеале переписать API на await feign_db.get_user_by_login(login)
-        return self._get_user_sync(login)
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            try:
+                # 1. Update LISTHAFF
+                update_query = """
+                               UPDATE LISTHAFF
+                               SET DOTINSKL    = COALESCE(DOTINSKL, ?),
+                                   NCAR        = ?,
+                                   DOTINSKLPOV = ?
+                               WHERE IDLISTHAFF = ? \
+                                 AND IDPRNT = ? \
+                               """
+                cursor.execute(update_query, (time_val, platform, time_val, firstpart, secondpart))
+
+                # 2. Find DOGOVOR и сразу считаем оставшиеся непринятые изделия по нему
+                find_dogovor_query = """
+                                     SELECT c.IDDOGOVOR,
+                                            (SELECT COUNT(*)
+                                             FROM LISTHAFF a2
+                                                      JOIN LISTIZD b2 ON a2.IDIZD = b2.ID
+                                             WHERE b2.IDDOG = c.IDDOGOVOR \
+                                               AND a2.DOTINSKL IS NULL)
+                                     FROM LISTHAFF a
+                                              JOIN LISTIZD b ON a.IDIZD = b.ID
+                                              JOIN DOGOVOR c ON b.IDDOG = c.IDDOGOVOR
+                                     WHERE a.IDLISTHAFF = ? \
+                                       AND a.IDPRNT = ? \
+                                     """
+                cursor.execute(find_dogovor_query, (firstpart, secondpart))
+                res = cursor.fetchone()
+
+                if res:
+                    iddogovor, remaining = res[0], res[1]
+                    # 3. Check remaining
+                    if remaining == 0:
+                        cursor.execute("UPDATE DOGOVOR SET SOSDOG = 4 WHERE IDDOGOVOR = ?", (iddogovor,))
+                        # EXECUTE PROCEDURE часто требует commit для применения эффекта
+                        cursor.execute("EXECUTE PROCEDURE MAKEDOC(?, ?)", (iddogovor, time_val))
+
+                conn.commit()
+                logger.info(f"Firebird: Сохранено product={product} platform={platform}")
+                return True
+
+            except Exception as e:
+                conn.rollback()
+                logger.error(f"Firebird Error in save_pair: {e}")
+                raise
+            finally:
+                cursor.close()
+
+    # Асинхронные обертки: блокирующий драйвер firebirdsql работает только в executor,
+    # каждый поток executor-а берет свое соединение из пула
+    async def get_user_by_login(self, login: str) -> Optional[Dict]:
+        entry = self._user_cache.get(login)
+        if entry is not None:
+            expires_at, user = entry
+            if expires_at >= monotonic():
+                self._user_cache.move_to_end(login)
+                return user
+            del self._user_cache[login]
+
+        # Конкурентные запросы одного логина ждут один запрос к Firebird
+        future = self._user_inflight.get(login)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self._executor, self._get_user_sync, login)
+            self._user_inflight[login] = future
+            future.add_done_callback(lambda f: self._on_user_loaded(login, f))
+        return await asyncio.shield(future)
+
+    def _on_user_loaded(self, login: str, future: asyncio.Future):
+        if self._user_inflight.get(login) is future:
+            del self._user_inflight[login]
+        if future.cancelled() or future.exception() is not None:
+            return
+        user = future.result()
+        if user is not None:
+            self._user_cache[login] = (monotonic() + USER_CACHE_TTL, user)
+            self._user_cache.move_to_end(login)
+            if len(self._user_cache) > USER_CACHE_SIZE:
+                self._user_cache.popitem(last=False)
 
     async def save_pair(self, platform: int, product: int) -> bool:
         # Асинхронная обертка для тяжелой операции записи
@@ -145,7 +207,18 @@ class FeignDatabase:
             product
         )
 
+    async def ping(self) -> bool:
+        """Проверяет соединение с Firebird."""
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, self._ping_sync)
+        except Exception as e:
+            logger.error(f"Firebird ping failed: {e}")
+            return False
+
     def close(self):
-        if self.connection:
-            self.connection.close()
         self._executor.shutdown()
+        while not self._pool.empty():
+            conn = self._pool.get_nowait()
+            if conn is not None:
+                conn.close()
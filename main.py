@@ -1,14 +1,18 @@
 import logging
 import jwt
 import os
+from collections import OrderedDict
 from contextlib import asynccontextmanager
 from typing import Optional
 from pathlib import Path
 import asyncio
+import stat
 import sys
-from datetime import datetime
+import time
+from time import monotonic
+from datetime import date, datetime
 
-from fastapi.encoders import jsonable_encoder
+import orjson
 
 if "_patch_asyncio" in asyncio.run.__qualname__:
     import asyncio.runners
@@ -16,15 +20,16 @@ if "_patch_asyncio" in asyncio.run.__qualname__:
     asyncio.run = asyncio.runners.run
 
 from dotenv import load_dotenv
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Query, HTTPException
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Query, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from pydantic import BaseModel
-from starlette.responses import FileResponse
+from starlette.responses import FileResponse, Response, StreamingResponse
 
 from database import DatabaseManager
 from connection_manager import ConnectionManager
 from feign_database import FeignDatabase
-from models import ConnectionType
+from models import ConnectionType, CONNECTION_TYPE_BY_NAME
 
 load_dotenv()
 
@@ -44,53 +49,69 @@ GREY = '\033[90m'
 class SpringLikeFormatter(logging.Formatter):
     """Форматер логов в стиле Spring Boot"""
 
+    # Уровни с цветом и выравниванием считаем один раз
+    _LEVEL_DISPLAY = {
+        level: f"{color}{('WARN' if level == 'WARNING' else level)[:5].ljust(5)}{RESET}"
+        for level, color in COLORS.items()
+    }
+    _NAME_MAP = {
+        "uvicorn.access": "http.access",
+        "uvicorn.error": "http.error",
+        "__main__": "main",
+    }
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Кэш метки времени за текущую секунду: (секунда, строка)
+        self._last_ts = (None, "")
+        self._name_cache = {}
+        self._pid_display = None
+
     def format(self, record):
-        # Timestamp
-        asctime = datetime.fromtimestamp(record.created).strftime('%Y-%m-%d %H:%M:%S')
-        msec = int(record.msecs)
-        timestamp = f"{asctime}.{msec:03d}"
+        # Timestamp: strftime вызывается не чаще раза в секунду
+        sec = int(record.created)
+        cached_sec, asctime = self._last_ts
+        if sec != cached_sec:
+            asctime = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(sec))
+            self._last_ts = (sec, asctime)
 
         # Log level с цветом
-        level_name = record.levelname
-        if level_name == "WARNING":
-            level_name = "WARN"
-
-        level_display = level_name[:5].ljust(5)
-        color = COLORS.get(record.levelname, '')
-        if color:
-            level_display = f"{color}{level_display}{RESET}"
+        level_display = self._LEVEL_DISPLAY.get(record.levelname)
+        if level_display is None:
+            level_display = record.levelname[:5].ljust(5)
 
         # Logger name
-        logger_name = record.name
-        if logger_name == "uvicorn.access":
-            logger_name = "http.access"
-        elif logger_name == "uvicorn.error":
-            logger_name = "http.error"
-        elif logger_name == "__main__":
-            logger_name = "main"
-
-        logger_name = logger_name[-30:].ljust(30)
-        logger_name_display = f"{GREY}{logger_name}{RESET}"
+        logger_name_display = self._name_cache.get(record.name)
+        if logger_name_display is None:
+            logger_name = self._NAME_MAP.get(record.name, record.name)
+            logger_name_display = f"{GREY}{logger_name[-30:].ljust(30)}{RESET}"
+            self._name_cache[record.name] = logger_name_display
 
         # Process ID
-        pid = str(record.process).ljust(5)
-        pid_display = f"{GREY}{pid}{RESET}"
+        pid_display = self._pid_display
+        if pid_display is None or pid_display[0] != record.process:
+            pid_display = (record.process, f"{GREY}{str(record.process).ljust(5)}{RESET}")
+            self._pid_display = pid_display
 
-        # Message
-        message = record.getMessage()
-
-        return f"{timestamp}  {level_display} {pid_display} --- [{logger_name_display}] : {message}"
+        return "%s.%03d  %s %s --- [%s] : %s" % (
+            asctime, int(record.msecs), level_display, pid_display[1], logger_name_display, record.getMessage()
+        )
 
 
 class EndpointFilter(logging.Filter):
     """Фильтрует шумные endpoints из логов доступа"""
 
+    NOISY_PATHS = ("/health", "/api/stats")
+
     def filter(self, record):
-        msg = record.getMessage()
-        # Не логируем health checks и stats
-        if "/health" in msg or "/api/stats" in msg:
-            return False
-        return True
+        # uvicorn.access передает путь третьим аргументом: (client, method, path, http_version, status)
+        args = record.args
+        if isinstance(args, tuple) and len(args) >= 3 and isinstance(args[2], str):
+            path = args[2]
+        else:
+            path = str(record.msg)
+        # Не логируем health checks и stats, не форматируя сообщение
+        return not any(p in path for p in self.NOISY_PATHS)
 
 
 def setup_logging():
@@ -130,13 +151,99 @@ FEIGN_DATABASE_URL = os.getenv("FEIGN_DATABASE_URL",
 
 IMAGE_DIR = Path(os.getenv("IMAGE_DIR", "./svg_output")).resolve()
 PORT = int(os.getenv("PORT", "8000"))
+# Картинки продуктов меняются только при повторном импорте
+IMAGE_CACHE_HEADERS = {"Cache-Control": "public, max-age=86400"}
+# Размер пула соединений PostgreSQL (на каждый воркер)
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "5"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "20"))
+# Одновременных выгрузок /api/history/stream на воркер (каждая держит соединение пула)
+DB_MAX_STREAMS = int(os.getenv("DB_MAX_STREAMS", str(max(1, DB_POOL_MAX_SIZE // 4))))
+# За PgBouncer в режиме transaction prepared statements между транзакциями не переживают
+PGBOUNCER_MODE = os.getenv("PGBOUNCER_MODE", "")
+DB_STATEMENT_CACHE_SIZE = 0 if PGBOUNCER_MODE == "transaction" else 1024
+# Число соединений с Firebird (и потоков для запросов к нему)
+FEIGN_POOL_SIZE = int(os.getenv("FEIGN_POOL_SIZE", "4"))
+# Рассылка по платформам и событий сканеров через PostgreSQL NOTIFY (нужно при нескольких воркерах).
+# LISTEN держит сессию, поэтому с PGBOUNCER_MODE=transaction рассылка работать не будет
+CLUSTER_BROADCAST = os.getenv("CLUSTER_BROADCAST", "0") == "1"
+# Число процессов uvicorn при запуске через python main.py
+WORKERS = int(os.getenv("WORKERS", "1"))
+# Разрешенные origin-ы через запятую; по умолчанию — любые (без credentials)
+CORS_ORIGINS = [origin.strip() for origin in os.getenv("CORS_ORIGINS", "*").split(",") if origin.strip()]
+# Верхняя граница размера страницы /api/history
+MAX_PAGE_SIZE = 1000
+# Строк на пачку (и на выборку курсора) в /api/history/stream
+HISTORY_STREAM_CHUNK = 200
 
 logger.info(f"CONFIG: IMAGE_DIR={IMAGE_DIR}")
 logger.info(f"CONFIG: PORT={PORT}")
+logger.info(f"CONFIG: CLUSTER_BROADCAST={CLUSTER_BROADCAST}")
+if CLUSTER_BROADCAST and PGBOUNCER_MODE == "transaction":
+    logger.warning("CLUSTER_BROADCAST=1 несовместим с PGBOUNCER_MODE=transaction: LISTEN не получит уведомлений")
+logger.info(f"CONFIG: CORS_ORIGINS={CORS_ORIGINS}")
+logger.info(f"CONFIG: DB_POOL_SIZE={DB_POOL_MIN_SIZE}..{DB_POOL_MAX_SIZE}")
+logger.info(f"CONFIG: DB_STATEMENT_CACHE_SIZE={DB_STATEMENT_CACHE_SIZE}")
+logger.info(f"CONFIG: FEIGN_POOL_SIZE={FEIGN_POOL_SIZE}")
 logger.info(f"CONFIG: DATABASE_URL={DATABASE_URL.split('@')[0]}@***")
 logger.info(f"CONFIG: FEIGN_DATABASE_URL={FEIGN_DATABASE_URL.split('@')[0]}@***")
 
 
+# Кэш проверенных JWT: повторные подключения сканеров не пересчитывают HMAC
+JWT_CACHE_SIZE = 10_000
+JWT_CACHE_TTL = 300.0
+_jwt_cache: "OrderedDict[str, tuple[float, dict]]" = OrderedDict()
+# Выданные токены по содержимому payload: /auth/login с теми же данными не подписывает заново
+_token_cache: "OrderedDict[tuple, tuple[float, str]]" = OrderedDict()
+
+# Кодек и ключ JWT создаются один раз, а не на каждый вызов
+_jwt = jwt.PyJWT()
+_JWT_KEY = JWT_SECRET.encode()
+_JWT_ALGORITHMS = ["HS256"]
+
+
+def encode_token(payload: dict) -> str:
+    """Выпускает JWT; токен без exp детерминирован, поэтому повторный вход того же пользователя берется из кэша."""
+    key = tuple(payload.items())
+    entry = _token_cache.get(key)
+    if entry is not None and entry[0] >= monotonic():
+        _token_cache.move_to_end(key)
+        return entry[1]
+
+    token = _jwt.encode(payload, _JWT_KEY, algorithm=_JWT_ALGORITHMS[0])
+    _token_cache[key] = (monotonic() + JWT_CACHE_TTL, token)
+    _token_cache.move_to_end(key)
+    if len(_token_cache) > JWT_CACHE_SIZE:
+        _token_cache.popitem(last=False)
+    # Выданный токен сразу считается проверенным — регистрация по /ws не пересчитает подпись
+    if token not in _jwt_cache:
+        _jwt_cache[token] = (monotonic() + JWT_CACHE_TTL, dict(payload))
+        if len(_jwt_cache) > JWT_CACHE_SIZE:
+            _jwt_cache.popitem(last=False)
+    return token
+
+
+def decode_token(token: str) -> dict:
+    """Проверяет JWT; успешный результат кэшируется на JWT_CACHE_TTL, ошибки не кэшируются."""
+    entry = _jwt_cache.get(token)
+    if entry is not None:
+        expires_at, payload = entry
+        if expires_at >= monotonic():
+            _jwt_cache.move_to_end(token)
+            return payload
+        del _jwt_cache[token]
+
+    payload = _jwt.decode(token, _JWT_KEY, algorithms=_JWT_ALGORITHMS)
+    ttl = JWT_CACHE_TTL
+    # Если в токене есть exp, запись не должна пережить сам токен
+    if "exp" in payload:
+        ttl = min(ttl, payload["exp"] - time.time())
+    if ttl > 0:
+        _jwt_cache[token] = (monotonic() + ttl, payload)
+        if len(_jwt_cache) > JWT_CACHE_SIZE:
+            _jwt_cache.popitem(last=False)
+    return payload
+
+
 # ===================== MODELS =====================
 
 class LoginCredentials(BaseModel):
@@ -153,18 +260,22 @@ async def lifespan(app: FastAPI):
     logger.info("STARTING APPLICATION")
     logger.info("═" * 80)
 
-    db = DatabaseManager(dsn=DATABASE_URL)
+    db = DatabaseManager(dsn=DATABASE_URL, min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE,
+                         statement_cache_size=DB_STATEMENT_CACHE_SIZE, max_streams=DB_MAX_STREAMS)
+    manager = None
+    feign_db = None
     try:
         logger.info("Инициализация PostgreSQL...")
         await db.init_database()
         logger.info("PostgreSQL инициализирована")
 
         logger.info("Инициализация Firebird...")
-        feign_db = FeignDatabase(FEIGN_DATABASE_URL)
+        feign_db = FeignDatabase(FEIGN_DATABASE_URL, pool_size=FEIGN_POOL_SIZE)
         logger.info("Firebird инициализирована")
 
         logger.info("Инициализация Connection Manager...")
-        manager = ConnectionManager(db, feign_db)
+        manager = ConnectionManager(db, feign_db, cluster_broadcast=CLUSTER_BROADCAST)
+        await manager.start()
         logger.info("Connection Manager готов")
 
         app.state.db = db
@@ -183,7 +294,11 @@ async def lifespan(app: FastAPI):
         logger.info("═" * 80)
         logger.info("SHUTTING DOWN")
         logger.info("═" * 80)
+        if manager:
+            await manager.close()
         await db.close()
+        if feign_db:
+            feign_db.close()
         logger.info("Соединения закрыты")
 
 
@@ -193,61 +308,135 @@ app = FastAPI(title="Scanner Backend", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
+    allow_origins=CORS_ORIGINS,
+    # Credentials допустимы только с явным списком origin-ов; "*" в любом месте списка включает allow-all
+    allow_credentials="*" not in CORS_ORIGINS,
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Сжимаем крупные ответы (история, графики, SVG) — данные идут через туннель
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
 
 
 # ===================== ENDPOINTS =====================
 
+def _parse_after(after_scan_date: Optional[str], after_id: Optional[int]) -> Optional[tuple[datetime, int]]:
+    """Keyset-курсор: (scan_date, id) последней строки предыдущей страницы (поле next_cursor ответа)."""
+    if after_scan_date is None and after_id is None:
+        return None
+    if after_scan_date is None or after_id is None:
+        raise HTTPException(status_code=400, detail="after_scan_date and after_id must be given together")
+    try:
+        scan_date = datetime.fromisoformat(after_scan_date)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="after_scan_date must be an ISO 8601 datetime")
+    # scan_date хранится без часового пояса — курсор тоже должен быть без него, как в next_cursor
+    if scan_date.tzinfo is not None:
+        raise HTTPException(status_code=400, detail="after_scan_date must not include a timezone offset")
+    return scan_date, after_id
+
+
 @app.get("/api/history")
 async def get_history(
         id: Optional[int] = Query(None),
-        date_from: Optional[str] = Query(None),
-        date_to: Optional[str] = Query(None),
+        date_from: Optional[date] = Query(None),
+        date_to: Optional[date] = Query(None),
         platform: Optional[int] = Query(None),
         login: Optional[str] = Query(None),
         product: Optional[int] = Query(None),
         legacy_synced: Optional[int] = Query(None),
         is_overwritten: Optional[bool] = Query(None),
-        size: int = Query(100),
-        page: int = Query(1),
+        size: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
+        page: int = Query(1, ge=1),
         sort: Optional[str] = Query(None),
+        after_scan_date: Optional[str] = Query(None),
+        after_id: Optional[int] = Query(None),
+        with_total: Optional[bool] = Query(None),
 ):
     db: DatabaseManager = app.state.db
     offset = (page - 1) * size
 
+    after = _parse_after(after_scan_date, after_id)
+
     logger.debug(f"GET /api/history: platform={platform}, product={product}, page={page}, size={size}")
 
     try:
-        items = await db.get_scan_pairs(
-            id=id, platform=platform, login=login, product=product,
-            legacy_synced=legacy_synced, date_from=date_from, date_to=date_to,
-            is_overwritten=is_overwritten, limit=size, offset=offset, sort=sort
-        )
+        # JSON страницы собирает PostgreSQL, здесь он вставляется в ответ как есть
+        # Общее количество нужно для первой страницы фильтра; дальше клиенту хватает has_more
+        if with_total is None:
+            with_total = page == 1 and after is None
 
-        total = await db.get_scan_pairs_count(
+        page_coro = db.get_scan_pairs_json(
             id=id, platform=platform, login=login, product=product,
             legacy_synced=legacy_synced, date_from=date_from, date_to=date_to,
-            is_overwritten=is_overwritten
+            is_overwritten=is_overwritten, limit=size, offset=offset, sort=sort, after=after
         )
+        if with_total:
+            # Страница и общее количество независимы — запрашиваем параллельно
+            (items_json, item_count, has_more, next_cursor_json), total = await asyncio.gather(
+                page_coro,
+                db.get_scan_pairs_count(
+                    id=id, platform=platform, login=login, product=product,
+                    legacy_synced=legacy_synced, date_from=date_from, date_to=date_to,
+                    is_overwritten=is_overwritten
+                )
+            )
+        else:
+            (items_json, item_count, has_more, next_cursor_json), total = await page_coro, None
+
+        # Общее количество в лог — только если его запрашивали
+        of_total = f"/{total}" if total is not None else ""
+        logger.info(f"/api/history returned {item_count}{of_total} items, has_more={has_more}")
 
-        logger.info(f"/api/history returned {len(items)}/{total} items")
+        pages = -(-total // size) if total is not None else None
 
-        return {
-            "items": items,
+        return Response(orjson.dumps({
+            "items": orjson.Fragment(items_json),
             "total": total,
             "page": page,
             "size": size,
-            "pages": (total + size - 1) // size if total > 0 else 0
-        }
+            "pages": pages,
+            "has_more": has_more,
+            "next_cursor": orjson.Fragment(next_cursor_json) if next_cursor_json else None
+        }), media_type="application/json")
     except Exception as e:
         logger.error(f"/api/history error: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="Internal server error")
 
 
+@app.get("/api/history/stream")
+async def stream_history(
+        date_from: Optional[date] = Query(None),
+        date_to: Optional[date] = Query(None),
+        platform: Optional[int] = Query(None),
+        login: Optional[str] = Query(None),
+        product: Optional[int] = Query(None),
+        legacy_synced: Optional[int] = Query(None),
+        is_overwritten: Optional[bool] = Query(None),
+        sort: Optional[str] = Query(None),
+):
+    """Вся история по фильтру в формате NDJSON (строка JSON на скан) без ограничения размера."""
+    db: DatabaseManager = app.state.db
+    logger.debug(f"GET /api/history/stream: platform={platform}, product={product}")
+
+    async def lines():
+        chunk = []
+        async for row in db.iter_scan_pairs(
+                platform=platform, login=login, product=product,
+                legacy_synced=legacy_synced, date_from=date_from, date_to=date_to,
+                is_overwritten=is_overwritten, sort=sort, prefetch=HISTORY_STREAM_CHUNK
+        ):
+            chunk.append(orjson.dumps(dict(row)))
+            # Отправляем пачками, а не по кадру на строку
+            if len(chunk) >= HISTORY_STREAM_CHUNK:
+                yield b"\n".join(chunk) + b"\n"
+                chunk = []
+        if chunk:
+            yield b"\n".join(chunk) + b"\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
 @app.post("/auth/login")
 async def authenticate_user(credentials: LoginCredentials):
     feign_db: FeignDatabase = app.state.feign_db
@@ -255,16 +444,16 @@ async def authenticate_user(credentials: LoginCredentials):
     logger.info(f"Auth attempt for user: {credentials.login}")
 
     try:
-        user = feign_db.get_user_by_login(credentials.login)
+        user = await feign_db.get_user_by_login(credentials.login)
         if not user:
             logger.warn(f"User not found: {credentials.login}")
             raise HTTPException(status_code=401, detail="Пользователь не найден")
 
-        token = jwt.encode({
+        token = encode_token({
             "login": credentials.login,
             "name": user["fullname"],
             "id": user["id"]
-        }, JWT_SECRET, algorithm="HS256")
+        })
 
         logger.info(f"Auth successful: {credentials.login} ({user['fullname']})")
 
@@ -280,12 +469,21 @@ async def get_scanners():
     try:
         scanners = await app.state.manager.get_users()
         logger.info(f"Returned {len(scanners)} scanners")
-        return scanners
+        return Response(orjson.dumps(scanners), media_type="application/json")
     except Exception as e:
         logger.error(f"Error fetching scanners: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="Internal server error")
 
 
+async def receive_message(websocket: WebSocket) -> dict:
+    """Читает один JSON-кадр (текстовый или бинарный) и разбирает его orjson без промежуточной строки."""
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000), message.get("reason"))
+    raw = message.get("bytes")
+    return orjson.loads(raw if raw is not None else message["text"])
+
+
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     manager: ConnectionManager = websocket.app.state.manager
@@ -298,7 +496,7 @@ async def websocket_endpoint(websocket: WebSocket):
     login, conn_type = None, ConnectionType.NONE
 
     try:
-        data = await websocket.receive_json()
+        data = await receive_message(websocket)
         event = data.get("event")
 
         if event != "register":
@@ -309,7 +507,7 @@ async def websocket_endpoint(websocket: WebSocket):
         token = data.get("token")
         if token:
             try:
-                payload = jwt.decode(token, JWT_SECRET, algorithms=["HS256"])
+                payload = decode_token(token)
                 login = payload.get("login")
                 logger.debug(f"  Token validated for: {login}")
             except Exception as e:
@@ -319,22 +517,28 @@ async def websocket_endpoint(websocket: WebSocket):
         else:
             login = data.get("login")
 
-        user = feign_db.get_user_by_login(login)
+        user = await feign_db.get_user_by_login(login)
         if not login or not user:
             logger.warn(f"User not found: {login}")
             await websocket.close(code=1008)
             return
 
-        conn_type = ConnectionType[data.get("type", "NONE")]
-        await manager.connect(websocket, user, conn_type)
+        requested_type = CONNECTION_TYPE_BY_NAME.get(data.get("type") or "NONE")
+        if requested_type is None:
+            logger.warn(f"Invalid connection type from {client_addr}: {data.get('type')}")
+            await websocket.close(code=1008)
+            return
+        conn_type = requested_type
+        # batch=true: клиент принимает рассылки, склеенные в JSON-массивы
+        user_context = await manager.connect(websocket, user, conn_type, batch=bool(data.get("batch")))
 
         logger.info(f"WebSocket registered: {login} ({user['fullname']}) as {conn_type.name}")
 
-        user_context = await manager.get_user(login)
-        await websocket.send_json(jsonable_encoder(user_context.to_dict()))
+        # to_dict содержит только простые типы — orjson сериализует его напрямую
+        await websocket.send_text(orjson.dumps(user_context.to_dict()).decode())
 
         while True:
-            msg = await websocket.receive_json()
+            msg = await receive_message(websocket)
             if msg.get("event") == "new_pair":
                 p_id = int(msg["platform"]) if msg.get("platform") else None
                 logger.debug(f"  {login}: new_pair event - platform={p_id}, product={msg.get('product')}")
@@ -352,8 +556,8 @@ async def websocket_endpoint(websocket: WebSocket):
 
 @app.get("/api/graphics")
 async def get_graphics_endpoint(
-        date_from: Optional[str] = Query(None),
-        date_to: Optional[str] = Query(None),
+        date_from: Optional[date] = Query(None),
+        date_to: Optional[date] = Query(None),
         platform: Optional[int] = Query(None),
 ):
     logger.debug(f"GET /api/graphics: platform={platform}, date_from={date_from}, date_to={date_to}")
@@ -362,72 +566,112 @@ async def get_graphics_endpoint(
         db: DatabaseManager = app.state.db
         data = await db.get_graphics_data(date_from=date_from, date_to=date_to, platform=platform)
         logger.info(f"/api/graphics returned {len(data)} data points")
-        return data
+        return Response(orjson.dumps(data), media_type="application/json")
     except Exception as e:
         logger.error(f"/api/graphics error: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="Internal server error")
 
 
+# Результат проверки здоровья переиспользуется, чтобы частые пробы не нагружали базы
+HEALTH_CACHE_TTL = 2.0
+_health_cache: Optional[tuple[float, dict]] = None
+_health_lock = asyncio.Lock()
+
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
-    status = {
-        "status": "ok",
-        "postgresql": "unknown",
-        "firebird": "unknown"
+    global _health_cache
+    if _health_cache is not None and _health_cache[0] > monotonic():
+        return _health_cache[1]
+    # Конкурентные пробы ждут одну проверку, а не запускают свои
+    async with _health_lock:
+        if _health_cache is None or _health_cache[0] <= monotonic():
+            _health_cache = (monotonic() + HEALTH_CACHE_TTL, await _check_health())
+        return _health_cache[1]
+
+
+async def _check_health() -> dict:
+    # Базы проверяем параллельно: время пробы — самая медленная из двух, а не сумма
+    postgresql, firebird = await asyncio.gather(_check_postgresql(), _check_firebird())
+    return {
+        "status": "ok" if postgresql == firebird == "ok" else "degraded",
+        "postgresql": postgresql,
+        "firebird": firebird
     }
 
+
+async def _check_postgresql() -> str:
     try:
         db: DatabaseManager = app.state.db
-        if await db.ping():
-            status["postgresql"] = "ok"
-        else:
-            status["postgresql"] = "disconnected"
-            status["status"] = "degraded"
+        return "ok" if await db.ping() else "disconnected"
     except Exception as e:
         logger.error(f"PostgreSQL health check failed: {e}")
-        status["postgresql"] = f"error"
-        status["status"] = "degraded"
+        return "error"
 
+
+async def _check_firebird() -> str:
     try:
         feign_db: FeignDatabase = app.state.feign_db
-        if feign_db and feign_db.connection:
-            try:
-                cur = feign_db.connection.cursor()
-                cur.execute("SELECT 1 FROM RDB$DATABASE")
-                cur.fetchone()
-                cur.close()
-                status["firebird"] = "ok"
-            except:
-                status["firebird"] = "disconnected"
-                status["status"] = "degraded"
-        else:
-            status["firebird"] = "disconnected"
-            status["status"] = "degraded"
+        return "ok" if feign_db and await feign_db.ping() else "disconnected"
     except Exception as e:
         logger.error(f"Firebird health check failed: {e}")
-        status["firebird"] = "error"
-        status["status"] = "degraded"
+        return "error"
 
-    return status
+
+def _resolve_image(image_path: str) -> Optional[tuple[Path, os.stat_result]]:
+    """Абсолютный путь картинки и ее stat; None, если файла нет или путь выходит за IMAGE_DIR."""
+    file_path = (IMAGE_DIR / image_path).resolve()
+    if not file_path.is_relative_to(IMAGE_DIR):
+        return None
+    try:
+        stat_result = os.stat(file_path)
+    except OSError:
+        return None
+    if not stat.S_ISREG(stat_result.st_mode):
+        return None
+    return file_path, stat_result
+
+
+def _etag_matches(etag: str, if_none_match: str) -> bool:
+    """Совпадает ли ETag со списком из If-None-Match (слабое сравнение, '*' — любой)."""
+    tag = etag.removeprefix("W/")
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == tag:
+            return True
+    return False
 
 
 @app.get("/api/image/{product}")
-async def get_image(product: int):
+async def get_image(product: int, request: Request):
     db: DatabaseManager = app.state.db
     image_path = await db.find_product_image(product)
+    if image_path is None:
+        raise HTTPException(status_code=404, detail="Image not found")
 
-    # Безопасный путь с абсолютным IMAGE_DIR
-    file_path = IMAGE_DIR / image_path
-
-    if not file_path.exists() or not file_path.is_file():
+    # resolve и stat блокируют поток — выполняем их вне event loop и передаем stat в FileResponse
+    resolved = await asyncio.to_thread(_resolve_image, image_path)
+    if resolved is None:
         raise HTTPException(status_code=404, detail="Image not found")
+    file_path, stat_result = resolved
 
-    return FileResponse(file_path)
+    response = FileResponse(file_path, stat_result=stat_result, headers=IMAGE_CACHE_HEADERS)
+    # ETag считает FileResponse по stat; совпадение с кэшем клиента — отвечаем 304 без тела
+    etag = response.headers.get("etag")
+    if etag and _etag_matches(etag, request.headers.get("if-none-match", "")):
+        return Response(status_code=304, headers={"ETag": etag, **IMAGE_CACHE_HEADERS})
+    return response
 
 
 if __name__ == "__main__":
     import uvicorn
 
     logger.info(f"Starting uvicorn on 0.0.0.0:{PORT}")
-    uvicorn.run(app, host="0.0.0.0", port=PORT)
+    if WORKERS > 1 and not CLUSTER_BROADCAST:
+        logger.warning("WORKERS > 1 без CLUSTER_BROADCAST=1: события сканеров и рассылка по платформам "
+                       "не дойдут до читателей на других воркерах")
+    # Несколько воркеров uvicorn запускает только по строке импорта приложения
+    # log_config=None: uvicorn не перенастраивает логгеры поверх setup_logging
+    uvicorn.run("main:app" if WORKERS > 1 else app, host="0.0.0.0", port=PORT, loop="uvloop", http="httptools",
+                ws_per_message_deflate=False, workers=WORKERS, log_config=None)
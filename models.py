@@ -16,4 +16,8 @@ class ConnectionType(Enum):
     NONE = 0
     READER = 1
     WRITER = 2
-    READWRITER = 3
\ No newline at end of file
+    READWRITER = 3
+
+
+# Тип подключения по имени из события register
+CONNECTION_TYPE_BY_NAME = {member.name: member for member in ConnectionType}
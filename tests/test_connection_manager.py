@@ -0,0 +1,147 @@
+import asyncio
+
+import orjson
+import pytest
+
+pytest.importorskip("asyncpg")
+pytest.importorskip("firebirdsql")
+
+from starlette.websockets import WebSocketState
+
+from connection_manager import ConnectionManager
+from models import ConnectionType
+
+USER = {"login": "tester", "id": 1, "fullname": "Tester"}
+
+
+class FakeWebSocket:
+    """Открытый сокет, запоминающий отправленные кадры."""
+
+    def __init__(self):
+        self.client_state = WebSocketState.CONNECTED
+        self.application_state = WebSocketState.CONNECTED
+        self.frames = []
+
+    async def send_text(self, text: str):
+        self.frames.append(text)
+
+
+def run_with_manager(test):
+    async def main():
+        manager = ConnectionManager(db=None, feign_db=None)
+        try:
+            return await test(manager)
+        finally:
+            await manager.close()
+
+    return asyncio.run(main())
+
+
+@pytest.mark.parametrize("batch", [False, True])
+def test_reader_registered_after_writer_gets_scanner_connected(batch):
+    async def test(manager):
+        writer, reader = FakeWebSocket(), FakeWebSocket()
+        await manager.connect(writer, USER, ConnectionType.WRITER)
+        await manager.connect(reader, USER, ConnectionType.READER, batch=batch)
+        # Отправитель соединения забирает очередь в своей задаче
+        await asyncio.sleep(0.01)
+        return writer.frames, reader.frames
+
+    writer_frames, reader_frames = run_with_manager(test)
+
+    event = {"event": "scanner_connected"}
+    assert writer_frames == []
+    assert [orjson.loads(frame) for frame in reader_frames] == [[event] if batch else event]
+
+
+class FakeClusterDb:
+    """PostgreSQL для двух воркеров: NOTIFY доходит до всех подписчиков, сканы получают новые id."""
+
+    def __init__(self):
+        self.listeners = []
+        self.scan_id = 0
+
+    async def listen(self, channel: str, callback):
+        self.listeners.append((channel, callback))
+
+    async def notify(self, channel: str, payload: str):
+        for listen_channel, callback in self.listeners:
+            if listen_channel == channel:
+                callback(None, 0, channel, payload)
+
+    async def add_scan(self, scan_request):
+        self.scan_id += 1
+        return {"scan_id": self.scan_id, "old_id": None, "old_platform": None}
+
+    async def get_scan_pairs(self, **filters):
+        return []
+
+    async def update_sync_status(self, scan_id: int, status: int, error_msg=None):
+        pass
+
+
+class FakeFeignDb:
+    pool_size = 2
+
+    async def save_pair(self, platform: int, product: int) -> bool:
+        return True
+
+
+def run_with_cluster(test):
+    async def main():
+        db = FakeClusterDb()
+        workers = [ConnectionManager(db=db, feign_db=FakeFeignDb(), cluster_broadcast=True) for _ in range(2)]
+        for manager in workers:
+            await manager.start()
+        try:
+            return await test(*workers)
+        finally:
+            for manager in workers:
+                await manager.close()
+
+    return asyncio.run(main())
+
+
+def events(frames):
+    return [orjson.loads(frame)["event"] for frame in frames]
+
+
+def test_reader_on_another_worker_gets_scanner_events():
+    async def test(worker_a, worker_b):
+        writer, reader = FakeWebSocket(), FakeWebSocket()
+        await worker_b.connect(reader, USER, ConnectionType.READER)
+        await worker_a.connect(writer, USER, ConnectionType.WRITER)
+        await worker_a.handle_new_pair("tester", 1, 501)
+        await worker_a.disconnect(writer, "tester", ConnectionType.WRITER)
+        await asyncio.sleep(0.01)
+        return reader.frames
+
+    frames = run_with_cluster(test)
+
+    assert events(frames) == ["scanner_connected", "change_platform", "new_pair", "scanner_refused"]
+    assert orjson.loads(frames[2])["data"]["product"] == {"id": 501}
+
+
+def test_reader_joining_another_worker_later_gets_scanner_state():
+    async def test(worker_a, worker_b):
+        writer, reader = FakeWebSocket(), FakeWebSocket()
+        await worker_a.connect(writer, USER, ConnectionType.WRITER)
+        await worker_a.handle_new_pair("tester", 2, None)
+        await asyncio.sleep(0.01)
+        await worker_b.connect(reader, USER, ConnectionType.READER)
+        await worker_a.handle_new_pair("tester", 2, 502)
+        await asyncio.sleep(0.01)
+        return reader.frames
+
+    frames = run_with_cluster(test)
+
+    assert events(frames) == ["scanner_connected", "new_pair"]
+
+
+def test_sync_workers_follow_feign_pool_size():
+    async def test(worker_a, worker_b):
+        await worker_a.connect(FakeWebSocket(), USER, ConnectionType.WRITER)
+        await worker_a.handle_new_pair("tester", 1, 503)
+        return len(worker_a._sync_workers)
+
+    assert run_with_cluster(test) == FakeFeignDb.pool_size
@@ -0,0 +1,183 @@
+import asyncio
+import os
+from datetime import datetime
+
+import pytest
+
+asyncpg = pytest.importorskip("asyncpg")
+
+from database import DatabaseManager
+from models import ScanRequest
+
+# Тесты записи идут в реальный PostgreSQL: таблица scans в этой базе пересоздается
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+requires_db = pytest.mark.skipif(not TEST_DATABASE_URL, reason="TEST_DATABASE_URL не задан")
+
+
+def run_with_db(test, **options):
+    """Выполняет test(db) на чистой таблице scans; options уходят в DatabaseManager."""
+
+    async def main():
+        conn = await asyncpg.connect(TEST_DATABASE_URL)
+        try:
+            await conn.execute("DROP TABLE IF EXISTS scans")
+        finally:
+            await conn.close()
+
+        db = DatabaseManager(dsn=TEST_DATABASE_URL, min_size=1, max_size=4, **options)
+        await db.init_database()
+        try:
+            return await test(db)
+        finally:
+            await db.close()
+
+    return asyncio.run(main())
+
+
+async def fetch_scans(db: DatabaseManager, product: int):
+    async with db._connect() as conn:
+        return await conn.fetch("SELECT id, is_overwritten FROM scans WHERE product = $1 ORDER BY id", product)
+
+
+PLATFORMS = (1, 2, 3, 4)
+
+
+@requires_db
+def test_repeated_product_in_one_batch_overwrites_in_order():
+    async def test(db):
+        # Конкурентные вызовы попадают в одну пачку писателя
+        results = await asyncio.gather(*(
+            db.add_scan(ScanRequest(login="tester", platform=platform, product=1001))
+            for platform in PLATFORMS
+        ))
+        rows = await fetch_scans(db, 1001)
+        return results, rows
+
+    results, rows = run_with_db(test)
+
+    assert results[0]["old_id"] is None
+    for previous, current, previous_platform in zip(results, results[1:], PLATFORMS):
+        assert current["old_id"] == previous["scan_id"]
+        assert current["old_platform"] == previous_platform
+    assert [row["id"] for row in rows if not row["is_overwritten"]] == [results[-1]["scan_id"]]
+
+
+@requires_db
+def test_failing_scan_does_not_fail_the_rest_of_its_batch():
+    async def test(db):
+        return await asyncio.gather(
+            db.add_scan(ScanRequest(login="tester", platform=1, product=2001)),
+            # platform вне диапазона INTEGER — ошибка только этого скана
+            db.add_scan(ScanRequest(login="tester", platform=2 ** 40, product=2002)),
+            db.add_scan(ScanRequest(login="tester", platform=3, product=2003)),
+            return_exceptions=True
+        )
+
+    first, failed, last = run_with_db(test)
+
+    assert isinstance(failed, Exception)
+    assert first["scan_id"] is not None and first["old_id"] is None
+    assert last["scan_id"] is not None and last["old_id"] is None
+
+
+@requires_db
+def test_batch_lookup_picks_latest_scan_among_equal_dates():
+    async def test(db):
+        # Повтор продукта в одной пачке — обе записи получают одинаковый scan_date
+        first = await asyncio.gather(*(
+            db.add_scan(ScanRequest(login="tester", platform=platform, product=3001))
+            for platform in (1, 2)
+        ))
+        # Различные продукты — пачка идет через ADD_SCANS_BATCH_QUERY
+        second = await asyncio.gather(
+            db.add_scan(ScanRequest(login="tester", platform=3, product=3001)),
+            db.add_scan(ScanRequest(login="tester", platform=4, product=3002))
+        )
+        return first, second
+
+    first, second = run_with_db(test)
+
+    assert second[0]["old_id"] == first[-1]["scan_id"]
+    assert second[0]["old_platform"] == 2
+
+
+@requires_db
+def test_scan_date_comes_from_application_clock():
+    async def test(db):
+        before = datetime.now()
+        await asyncio.gather(*(
+            db.add_scan(ScanRequest(login="tester", platform=1, product=product))
+            for product in (4001, 4002)
+        ))
+        after = datetime.now()
+        async with db._connect() as conn:
+            dates = await conn.fetch("SELECT scan_date FROM scans ORDER BY id")
+        return before, after, [row["scan_date"] for row in dates]
+
+    before, after, dates = run_with_db(test)
+
+    assert len(set(dates)) == 1
+    assert before <= dates[0] <= after
+
+
+@pytest.mark.parametrize("sort, expected", [
+    (None, ("scan_date", "DESC")),
+    ("product,asc", ("product", "ASC")),
+    ("product", ("product", "DESC")),
+    ("unknown,asc", ("scan_date", "ASC")),
+    # Лишние части после направления игнорируются
+    ("scan_date,asc,extra", ("scan_date", "ASC")),
+    ("scan_date,asc extra", ("scan_date", "DESC")),
+])
+def test_parse_sort(sort, expected):
+    assert DatabaseManager._parse_sort(sort) == expected
+
+
+@requires_db
+def test_history_streams_are_limited():
+    async def test(db):
+        await db.add_scan(ScanRequest(login="tester", platform=1, product=5001))
+        first, second = db.iter_scan_pairs(), db.iter_scan_pairs()
+        await first.__anext__()
+        pending = asyncio.ensure_future(second.__anext__())
+        # Пока первая выгрузка открыта, вторая ждет слота
+        await asyncio.sleep(0.2)
+        waited = not pending.done()
+        await first.aclose()
+        row = await asyncio.wait_for(pending, 1)
+        await second.aclose()
+        return waited, row
+
+    waited, row = run_with_db(test, max_streams=1)
+
+    assert waited
+    assert row["product"] == 5001
+
+
+@requires_db
+def test_close_flushes_queued_scans():
+    async def main():
+        conn = await asyncpg.connect(TEST_DATABASE_URL)
+        try:
+            await conn.execute("DROP TABLE IF EXISTS scans")
+        finally:
+            await conn.close()
+
+        db = DatabaseManager(dsn=TEST_DATABASE_URL, min_size=1, max_size=4)
+        await db.init_database()
+        scans = [
+            asyncio.ensure_future(db.add_scan(ScanRequest(login="tester", platform=1, product=product)))
+            for product in range(6001, 6011)
+        ]
+        # Даем сканам попасть в очередь и сразу закрываем менеджер, не дожидаясь записи
+        await asyncio.sleep(0)
+        await db.close()
+        # Без дозаписи при close() future сканов не завершились бы никогда
+        results = await asyncio.wait_for(asyncio.gather(*scans), 5)
+        with pytest.raises(RuntimeError):
+            await db.add_scan(ScanRequest(login="tester", platform=1, product=6011))
+        return results
+
+    results = asyncio.run(main())
+
+    assert len({result["scan_id"] for result in results}) == 10
@@ -0,0 +1,77 @@
+from datetime import datetime
+
+import pytest
+
+pytest.importorskip("asyncpg")
+pytest.importorskip("firebirdsql")
+
+from fastapi import HTTPException
+
+import main
+from main import _etag_matches, _parse_after, _resolve_image
+
+
+@pytest.mark.parametrize("if_none_match, expected", [
+    ('"abc"', True),
+    ('W/"abc"', True),
+    ('"xyz", "abc"', True),
+    ('"xyz",W/"abc"', True),
+    ('*', True),
+    ('', False),
+    ('"ab"', False),
+    ('"abcd"', False),
+    ('"xyz", "abc-1"', False),
+])
+def test_etag_matches_whole_tags_only(if_none_match, expected):
+    assert _etag_matches('"abc"', if_none_match) is expected
+
+
+@pytest.fixture
+def image_dir(tmp_path, monkeypatch):
+    """IMAGE_DIR с одной картинкой и файлом-секретом рядом с ним, вне каталога."""
+    root = (tmp_path / "svg_output").resolve()
+    (root / "90").mkdir(parents=True)
+    (root / "90" / "458590_32.svg").write_text("<svg/>")
+    (tmp_path / "secret.svg").write_text("secret")
+    (root / "escape.svg").symlink_to(tmp_path / "secret.svg")
+    monkeypatch.setattr(main, "IMAGE_DIR", root)
+    return root
+
+
+def test_resolve_image_inside_image_dir(image_dir):
+    file_path, stat_result = _resolve_image("90/458590_32.svg")
+    assert file_path == image_dir / "90" / "458590_32.svg"
+    assert stat_result.st_size == len("<svg/>")
+
+
+@pytest.mark.parametrize("image_path", [
+    "../secret.svg",
+    "90/../../secret.svg",
+    "escape.svg",
+    "90",
+    "90/missing.svg",
+])
+def test_resolve_image_rejects_paths_outside_image_dir(image_dir, image_path):
+    assert _resolve_image(image_path) is None
+
+
+def test_resolve_image_rejects_absolute_path(image_dir):
+    assert _resolve_image(str(image_dir.parent / "secret.svg")) is None
+
+
+def test_parse_after_accepts_naive_cursor():
+    assert _parse_after(None, None) is None
+    assert _parse_after("2026-01-15T11:47:03.591180", 7) == (datetime(2026, 1, 15, 11, 47, 3, 591180), 7)
+
+
+@pytest.mark.parametrize("after_scan_date, after_id, detail", [
+    ("2026-01-15T11:47:03", None, "given together"),
+    (None, 7, "given together"),
+    ("yesterday", 7, "ISO 8601"),
+    ("2026-01-15T11:47:03+03:00", 7, "timezone"),
+])
+def test_parse_after_rejects_bad_cursor(after_scan_date, after_id, detail):
+    with pytest.raises(HTTPException) as error:
+        _parse_after(after_scan_date, after_id)
+    assert error.value.status_code == 400
+    assert detail in error.value.detail
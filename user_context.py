@@ -1,4 +1,4 @@
-from typing import List, Optional
+from typing import Optional, Set
 
 from starlette.websockets import WebSocket
 
@@ -8,8 +8,8 @@ class UserContext:
         self.login: str = login
         self.id: int = id
         self.fullname: str = fullname
-        self.input_connections: List[WebSocket] = []  # Входные соединения от сканнеров
-        self.output_connections: List[WebSocket] = []  # Выходные соединения от браузеров
+        self.input_connections: Set[WebSocket] = set()  # Входные соединения от сканнеров
+        self.output_connections: Set[WebSocket] = set()  # Выходные соединения от браузеров
         self.current_platform: Optional[int] = current_platform
 
     def to_dict(self):